@@ -1,4 +1,5 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from typing import Dict, List, NamedTuple
 
 @dataclass
 class Playlist:
@@ -6,6 +7,29 @@ class Playlist:
   id: str
   name: str
 
+class Song(NamedTuple):
+  """Holds a song read from a playlist CSV along with its normalized lookup keys."""
+  title: str
+  artist: str
+  sanitized_artist: str
+  key_title: str
+  key_artist: str
+  display: str
+
+@dataclass
+class ArtistTracks:
+  """Holds a Plex artist's tracks alongside their sanitized titles."""
+  tracks: List = field(default_factory=list)
+  titles: List[str] = field(default_factory=list)
+  by_title: Dict = field(default_factory=dict)
+
+  def add(self, track, sanitized_title):
+    """Adds a Plex track and the sanitized form of its title."""
+    self.tracks.append(track)
+    self.titles.append(sanitized_title)
+    # Keep the first track for a title, matching the order fuzzy matching prefers
+    self.by_title.setdefault(sanitized_title.lower(), track)
+
 @dataclass
 class UserInputs:
   """Provides methods for user input."""
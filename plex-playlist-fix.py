@@ -2,20 +2,60 @@ import os
 import json
 import logging
 import csv
+import shelve
 import sys
 import string
 import unidecode
 from typing import List
 from typing import Dict
-from difflib import SequenceMatcher
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 import plexapi
+import requests
+from requests.adapters import HTTPAdapter
 from plexapi.server import PlexServer
 from plexapi.exceptions import BadRequest, NotFound
+from plexapi.audio import Track
+from plexapi.playlist import Playlist as PlexPlaylist
+from rapidfuzz import fuzz, process
 
-from helperClasses import Playlist, UserInputs
+from helperClasses import ArtistTracks, Playlist, Song, UserInputs
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+# Named logger so this script's level can be set apart from plexapi's and urllib3's.
+# The script is always run as __main__, so __name__ would not identify it.
+logger = logging.getLogger("plex-playlist-fix")
+
+# Translation table mapping every punctuation character to None, except for periods,
+# plus the inverted question mark that string.punctuation does not cover
+PUNCTUATION_TABLE = str.maketrans('', '', string.punctuation.replace(".", "") + "¿")
+
+# Number of songs looked up on the Plex server concurrently
+MAX_SEARCH_WORKERS = 16
+
+# Artist tracks keyed by lowercased sanitized artist name, shared across playlists.
+# Seeded from the whole library by build_artist_index, filled in by searches on a miss;
+# None records an artist that Plex could not find.
+_artist_tracks_cache: Dict[str, Optional[ArtistTracks]] = {}
+
+# Best Plex track (or None) for each CSV song, shared across playlists
+_song_match_cache: Dict[Song, Optional[Track]] = {}
+
+# (artist, title) of the songs already in each playlist, fetched once per playlist
+_playlist_songs_cache: Dict[str, Set[Tuple[str, str]]] = {}
+
+# Tracks of the selected library keyed by ratingKey, used to resolve saved song matches
+_tracks_by_rating_key: Dict[int, Track] = {}
+
+# Entry in the song match store recording which library state its matches were made against
+MATCH_STORE_LIBRARY_KEY = "__library__"
+
+# Plex playlists keyed by (title, playlistType), listed from the server on first use
+_playlist_cache: Optional[Dict[Tuple[str, str], PlexPlaylist]] = None
 
 def load_config():
     try:
@@ -48,200 +88,318 @@ def prompt_plex_libraries(plex: PlexServer) -> PlexServer:
         print("Invalid choice. Aborting...")
         exit(0)
 
-def _get_available_plex_tracks(plex: PlexServer, songs: List[Dict[str, str]], playlist_name: str) -> List:
+def _get_available_plex_tracks(plex: PlexServer, music_section, songs: List[Song], playlist_name: str) -> List:
     plex_tracks, missing_tracks, found_tracks = [], [], []
     current_playlist_songs = get_current_playlist_songs(plex, playlist_name)
-    for song in songs:
-        sanitized_artist = sanitize_string(song['artist'])
-        track_string = f"{sanitized_artist} - {song['title']}"
-        if track_string in current_playlist_songs:
-            continue
-        search = []
-        try:
-            # Search for the artist first
-            artist_results = plex.library.section('Music').search(title=sanitized_artist, libtype='artist')
-            logging.info(f"Searching for artist: {sanitized_artist}")
-            if artist_results:
-                # Search for the track within the artist's tracks using get_best_matching_track
-                best_match = get_best_matching_track(song['title'], artist_results[0].tracks())
-                if best_match:
-                    found_tracks.append(song)  # Add the song to the found_tracks list
-                    plex_tracks.append(best_match)  # Store the matching Plex Track object
-                    logging.info(f"Found track: {track_string}")
-                else:
-                    logging.info(f"Track not found: {track_string}")
-                    missing_tracks.append(song)
-            else:
-                logging.info(f"Artist not found: {sanitized_artist}")
-                missing_tracks.append(song)
-        except BadRequest:
-            logging.info("Failed to search %s by %s on Plex", song['title'], sanitized_artist)
+    songs_to_search = [song for song in songs if (song.sanitized_artist, song.title) not in current_playlist_songs]
+
+    # Songs shared with an earlier playlist reuse that lookup, the rest are looked up once each.
+    # Artists missing from the library index need a Plex search, so overlap those round-trips,
+    # one per distinct artist, before matching titles against the now cached tracks.
+    new_songs = [song for song in dict.fromkeys(songs_to_search) if song not in _song_match_cache]
+    missing_artists = [key for key in dict.fromkeys(song.key_artist for song in new_songs) if key not in _artist_tracks_cache]
+    with ThreadPoolExecutor(max_workers=MAX_SEARCH_WORKERS) as executor:
+        list(executor.map(lambda artist_key: prefetch_artist_tracks(music_section, artist_key), missing_artists))
+    for song in new_songs:
+        _song_match_cache[song] = find_plex_track(music_section, song)
+
+    for song in songs_to_search:
+        best_match = _song_match_cache[song]
+        if best_match:
+            found_tracks.append(song)  # Add the song to the found_tracks list
+            plex_tracks.append(best_match)  # Store the matching Plex Track object
+        else:
             missing_tracks.append(song)
-            continue
 
+    logger.info("Found %d songs for playlist %s, %d missing, %d already in the playlist",
+                len(found_tracks), playlist_name, len(missing_tracks), len(songs) - len(songs_to_search))
     return plex_tracks, missing_tracks, found_tracks  # Return the found_tracks list
-    
+
+def find_plex_track(music_section, song: Song):
+    """Return the Plex track best matching song, or None if it could not be found."""
+    try:
+        # Search for the artist first
+        artist_tracks = search_artist_tracks(music_section, song.key_artist)
+    except BadRequest:
+        logger.info("Failed to search %s by %s on Plex", song.title, song.artist)
+        return None
+
+    # Per-song progress is DEBUG and lazily formatted; only misses are reported by default
+    logger.debug("Searching for artist: %s", song.artist)
+    if not artist_tracks:
+        logger.info("Artist not found: %s", song.artist)
+        return None
+
+    # Search for the track within the artist's tracks using get_best_matching_track
+    best_match = get_best_matching_track(song, artist_tracks)
+    if best_match:
+        logger.debug("Found track: %s", song.display)
+    else:
+        logger.info("Track not found: %s", song.display)
+    return best_match
+
+def build_artist_index(library) -> None:
+    """Fetch every track in the library once and group them by sanitized artist name."""
+    tracks = library.searchTracks()
+    for track in tracks:
+        artist_tracks = _artist_tracks_cache.setdefault(sanitize_string(track.grandparentTitle).lower(), ArtistTracks())
+        artist_tracks.add(track, sanitize_string(track.title))
+        _tracks_by_rating_key[track.ratingKey] = track
+    logger.info("Indexed %d tracks from %d artists in %s", len(tracks), len(_artist_tracks_cache), library.title)
+
+def _library_stamp(library) -> str:
+    return f"{library.uuid}:{library.updatedAt}"
+
+def load_song_matches(cache_directory: str, library) -> None:
+    """Seed the song match cache with matches saved by a previous run against the same library state."""
+    os.makedirs(cache_directory, exist_ok=True)
+    with shelve.open(os.path.join(cache_directory, "song_matches")) as store:
+        if store.get(MATCH_STORE_LIBRARY_KEY) != _library_stamp(library):
+            # The library changed since the matches were saved, so a better track may exist now
+            store.clear()
+            return
+        stale_keys = []
+        for key, rating_key in store.items():
+            if key == MATCH_STORE_LIBRARY_KEY:
+                continue
+            track = _tracks_by_rating_key.get(rating_key)
+            if track:
+                _song_match_cache[make_song(*json.loads(key))] = track
+            else:
+                stale_keys.append(key)  # The matched track is no longer in the library
+        for key in stale_keys:
+            del store[key]
+    logger.info("Loaded %d saved song matches from %s", len(_song_match_cache), cache_directory)
+
+def save_song_matches(cache_directory: str, library) -> None:
+    """Save the found song matches as ratingKeys so the next run can skip looking them up."""
+    with shelve.open(os.path.join(cache_directory, "song_matches")) as store:
+        store[MATCH_STORE_LIBRARY_KEY] = _library_stamp(library)
+        for song, track in _song_match_cache.items():
+            if track:
+                store[json.dumps([song.title, song.artist])] = track.ratingKey
+
+def search_artist_tracks(music_section, artist_key: str) -> Optional[ArtistTracks]:
+    """Return the tracks of the first Plex artist matching the lowercased sanitized artist_key, memoized per run."""
+    # Plex matches artist names case-insensitively, so the index and the search key are lowercased
+    if artist_key not in _artist_tracks_cache:
+        artist_results = music_section.search(title=artist_key, libtype='artist')
+        artist_tracks = None
+        if artist_results:
+            artist_tracks = ArtistTracks()
+            for track in artist_results[0].tracks():
+                artist_tracks.add(track, sanitize_string(track.title))
+        _artist_tracks_cache[artist_key] = artist_tracks
+    return _artist_tracks_cache[artist_key]
+
+def prefetch_artist_tracks(music_section, artist_key: str) -> None:
+    """Fill the artist cache for artist_key; a failed search is left for find_plex_track to report."""
+    try:
+        search_artist_tracks(music_section, artist_key)
+    except BadRequest:
+        pass
+
+def make_song(title: str, artist: str) -> Song:
+    """Build a Song, normalizing its title and artist once for all later comparisons."""
+    sanitized_artist = sanitize_string(artist)
+    return Song(title=title, artist=artist, sanitized_artist=sanitized_artist, key_title=sanitize_string(title).lower(),
+                key_artist=sanitized_artist.lower(), display=f"{artist} - {title}")
+
+def read_csv_header(csv_reader) -> Tuple[int, int]:
+    """Consume the header row and return the positions of the title and artist columns."""
+    header = next(csv_reader, ['title', 'artist'])  # An empty file has no header row
+    return header.index('title'), header.index('artist')
+
 def read_csv_files(csv_directory):
     playlist_data = {}
     
-    if not os.path.exists(csv_directory):
-        raise FileNotFoundError(f"Directory not found: {csv_directory}")
+    # A single directory pass; DirEntry caches the file type so no extra stat is needed
+    try:
+        with os.scandir(csv_directory) as entries:
+            csv_entries = [entry for entry in entries if entry.is_file() and entry.name.endswith(".csv")]
+    except FileNotFoundError:
+        raise FileNotFoundError(f"Directory not found: {csv_directory}") from None
     
-    if not os.listdir(csv_directory):
-        print(f"CSV directory '{csv_directory}' is empty.")
+    if not csv_entries:
+        print(f"CSV directory '{csv_directory}' contains no CSV files.")
         return playlist_data
     
-    for file_name in os.listdir(csv_directory):
-        if file_name.endswith(".csv"):
-            playlist_name = os.path.splitext(file_name)[0]
-            with open(os.path.join(csv_directory, file_name), "r", newline='') as csv_file:
-                csv_reader = csv.DictReader(csv_file)
-                songs = [{ 'title': row['title'], 'artist': row['artist'] } for row in csv_reader]
-                playlist_data[playlist_name] = songs
-                logging.info(f"Read {len(songs)} songs from {file_name}:")
-                for song in songs:
-                    logging.info(f"  {song}")
+    for entry in csv_entries:
+        playlist_name = os.path.splitext(entry.name)[0]
+        with open(entry.path, "r", newline='') as csv_file:
+            csv_reader = csv.reader(csv_file)
+            title_idx, artist_idx = read_csv_header(csv_reader)
+            songs = [make_song(row[title_idx], row[artist_idx]) for row in csv_reader if row]
+            playlist_data[playlist_name] = songs
+            logger.info("Read %d songs from %s", len(songs), entry.name)
     
     return playlist_data
 
 def fetch_playlist(plex, playlist_name, playlist_type='audio'):
-    try:
-        playlists = plex.playlists()
+    global _playlist_cache
+    if _playlist_cache is None:
+        try:
+            playlists = plex.playlists()
+        except NotFound:
+            logger.info("Playlist %s not found.", playlist_name)
+            return None
+        _playlist_cache = {}
         for playlist in playlists:
-            if playlist.title == playlist_name and playlist.playlistType == playlist_type:
-                return playlist
-        return None
-    except NotFound:
-        logging.info(f"Playlist {playlist_name} not found.")
-        return None
+            # Keep the first playlist with a given name, as the old linear scan did
+            _playlist_cache.setdefault((playlist.title, playlist.playlistType), playlist)
+    return _playlist_cache.get((playlist_name, playlist_type))
 
 def get_current_playlist_songs(plex, playlist_name):
-    playlist = fetch_playlist(plex, playlist_name)
-    if not playlist:
-        logging.error(f"Playlist {playlist_name} does not exist.")
-        return []
-    return [f"{item.artist().title} - {item.title}" for item in playlist.items()]
-
-def get_best_matching_track(title: str, plex_tracks: List) -> dict:
-    best_match = None
-    highest_ratio = 0
-
-    for plex_track in plex_tracks:
-        sanitized_title = sanitize_string(plex_track.title)
-        ratio = SequenceMatcher(None, title, sanitized_title).ratio()
-        ### delete hashes for more logging info
-        ### logging.info(f"Matching {title} with {sanitized_title}, ratio: {ratio}")
-        if ratio > highest_ratio:
-            highest_ratio = ratio
-            best_match = plex_track
-
-    return best_match
+    if playlist_name not in _playlist_songs_cache:
+        playlist = fetch_playlist(plex, playlist_name)
+        if not playlist:
+            logger.error("Playlist %s does not exist.", playlist_name)
+            return set()
+        # grandparentTitle is the artist() title, already loaded with the items, so no fetch per item
+        _playlist_songs_cache[playlist_name] = {(item.grandparentTitle, item.title) for item in playlist.items()}
+    return _playlist_songs_cache[playlist_name]
+
+def get_best_matching_track(song: Song, artist_tracks: ArtistTracks) -> Optional[Track]:
+    # Most CSV titles match a Plex title exactly once both are sanitized, so try that first
+    exact_match = artist_tracks.by_title.get(song.key_title)
+    if exact_match:
+        return exact_match
+
+    # Plex titles were sanitized once when the artist's tracks were indexed. extractOne scans
+    # them in C, keeps the first best score, stops early on an exact match and uses the best
+    # score so far to skip candidates that cannot beat it.
+    match = process.extractOne(song.title, artist_tracks.titles, scorer=fuzz.ratio, processor=None)
+    ### delete hashes for more logging info
+    ### logger.info("Matching %s with %s", song.title, match)
+    if not match or match[1] <= 0:
+        return None
+    return artist_tracks.tracks[match[2]]
 
+@lru_cache(maxsize=100_000)
 def sanitize_string(input_string: str) -> str:
-    # Create a translation table mapping every punctuation character to None, except for periods
-    translator = str.maketrans('', '', string.punctuation.replace(".", ""))
-
-    # Use the table to remove all punctuation from the input_string
-    sanitized_string = input_string.translate(translator)
-
-    # Remove question marks
-    sanitized_string = sanitized_string.replace("?", "")
-    sanitized_string = sanitized_string.replace("¿", "")
+    # Use the table to remove all punctuation and inverted question marks from the input_string in one pass
+    sanitized_string = input_string.translate(PUNCTUATION_TABLE)
 
     # Convert accented letters to their unaccented versions
     sanitized_string = unidecode.unidecode(sanitized_string)
 
     return sanitized_string
 
-def add_tracks_to_playlist(plex, playlist_name, tracks):
+def add_tracks_to_playlist(plex, playlist_name, tracks: List[Track]):
     playlist = fetch_playlist(plex, playlist_name)
     if not playlist:
-        logging.error(f"Playlist {playlist_name} does not exist.")
+        logger.error("Playlist %s does not exist.", playlist_name)
         return
 
     if not tracks:
-        logging.info("No tracks to add.")
-        return
+        logger.info("No tracks to add.")
+        return 0
 
     # Get current playlist tracks
-    current_playlist_tracks = [f"{item.artist().title} - {item.title}" for item in playlist.items()]
+    current_playlist_tracks = get_current_playlist_songs(plex, playlist_name)
+
+    # Filter out tracks that are already in the playlist; the Plex tracks were matched by _get_available_plex_tracks.
+    # Several CSV songs can match the same Plex track, so each ratingKey is added only once.
+    unique_tracks = {}
+    for track in tracks:
+        if (track.grandparentTitle, track.title) not in current_playlist_tracks:
+            unique_tracks.setdefault(track.ratingKey, track)
+    track_objects = list(unique_tracks.values())
+    if not track_objects:
+        logger.info("All matched tracks are already in the playlist.")
+        return 0
 
-    # Filter out tracks that are already in the playlist
-    tracks_to_add = [track for track in tracks if f"{track['artist']} - {track['title']}" not in current_playlist_tracks]
-
-    # Fetch Track objects from Plex
-    track_objects = []
-    for track in tracks_to_add:
-        sanitized_artist = sanitize_string(track['artist'])
-        artist_results = plex.library.section('Music').searchArtists(title=sanitized_artist)
-        if artist_results:
-            artist_tracks = artist_results[0].tracks()
-            best_match = get_best_matching_track(track['title'], artist_tracks)
-            if best_match:
-                track_objects.append(best_match)
-            else:
-                logging.error(f"Track {track['title']} by {track['artist']} not found in Plex library.")
-        else:
-            logging.error(f"Artist {sanitized_artist} not found. {track['title']} by {track['artist']} not added.")
     try:
         playlist.addItems(track_objects)
-        logging.info(f"Successfully added {len(track_objects)} tracks to playlist.")
+        # addItems() leaves the handle's cached items() stale, so record the additions in the cached set directly
+        current_playlist_tracks.update((track.grandparentTitle, track.title) for track in track_objects)
+        logger.info("Successfully added %d tracks to playlist.", len(track_objects))
         return len(track_objects)  # Return the number of successfully added tracks
     except Exception as e:
-        logging.error(f"Failed to add tracks to playlist: {e}")
-        return 0  # Return 0 if no tracks were added due to an error
+        logger.error("Failed to add tracks to playlist: %s", e)
+        return None  # None means the add failed, unlike 0 when there was nothing new to add
 
-def confirm_and_add_tracks(plex, playlist_name, missing_tracks, found_tracks, csv_directory):
+def confirm_and_add_tracks(plex, playlist_name, plex_tracks, missing_tracks, found_tracks, csv_directory):
     playlist = fetch_playlist(plex, playlist_name)
     if not playlist:
-        logging.error(f"Playlist {playlist_name} does not exist and will not be created.")
+        logger.error("Playlist %s does not exist and will not be created.", playlist_name)
         return
 
     tracks_to_add = found_tracks  # Use the found_tracks list when creating tracks_to_add
 
     if tracks_to_add:
-        confirmation = UserInputs.input(f"Add {len(tracks_to_add)} tracks to playlist (y/N)? ")
+        confirmation = UserInputs.input(f"Add {len(tracks_to_add)} tracks to playlist {playlist_name} (y/N)? ")
         if confirmation.lower() == 'y':
-            num_added_tracks = add_tracks_to_playlist(plex, playlist_name, tracks_to_add)  # Get the number of added tracks
-            logging.info(f"Added {num_added_tracks} tracks to the playlist {playlist_name}.")  # Log the number of added tracks
+            num_added_tracks = add_tracks_to_playlist(plex, playlist_name, plex_tracks)  # Get the number of added tracks
+
+            # The add failed, so keep every song in the CSV for the next run
+            if num_added_tracks is None:
+                return
+            logger.info("Added %d tracks to the playlist %s.", num_added_tracks, playlist_name)  # Log the number of added tracks
 
-            # Remove successfully added tracks from CSV
+            # Remove successfully added tracks from CSV, reading and rewriting it through one handle;
+            # found songs whose track was already in the playlist are removed as well
             csv_file_path = os.path.join(csv_directory, f"{playlist_name}.csv")
-            with open(csv_file_path, "r") as csv_file:
-                csv_reader = csv.DictReader(csv_file)
-                remaining_tracks = [row for row in csv_reader if {'title': row['title'], 'artist': row['artist']} not in tracks_to_add]
-
-            # Write remaining tracks back to CSV
-            with open(csv_file_path, "w", newline='') as csv_file:
-                fieldnames = ['title', 'artist']
-                csv_writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-                csv_writer.writeheader()
-                # Only consider 'title' and 'artist' fields for each track
-                remaining_tracks_filtered = [{'title': track['title'], 'artist': track['artist']} for track in remaining_tracks]
-                csv_writer.writerows(remaining_tracks_filtered)
+            added_songs = {(song.title, song.artist) for song in tracks_to_add}  # One hash lookup per row
+            with open(csv_file_path, "r+", newline='') as csv_file:
+                csv_reader = csv.reader(csv_file)
+                title_idx, artist_idx = read_csv_header(csv_reader)
+                # Only keep the 'title' and 'artist' fields for each track
+                remaining_tracks = [(row[title_idx], row[artist_idx]) for row in csv_reader
+                                    if row and (row[title_idx], row[artist_idx]) not in added_songs]
+
+                # Write remaining tracks back over the CSV
+                csv_file.seek(0)
+                csv_writer = csv.writer(csv_file)
+                csv_writer.writerow(['title', 'artist'])
+                csv_writer.writerows(remaining_tracks)
+                csv_file.truncate()
         else:
-            logging.info("No new tracks were added.")
+            logger.info("No new tracks were added.")
 
 def main():
     config = load_config()
     csv_directory = config.get("directories", {}).get("csv")
+    cache_directory = config.get("directories", {}).get("cache")
     plex_api = config.get("plex_api")
     plex_url = plex_api.get("base_url")
     plex_token = plex_api.get("token")
 
-    plex = PlexServer(plex_url, plex_token)
+    # requests keeps 10 connections per host by default; size the pool to the lookup threads
+    # so concurrent searches reuse connections instead of opening and discarding extra ones
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=MAX_SEARCH_WORKERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    plex = PlexServer(plex_url, plex_token, session=session)
     selected_library = prompt_plex_libraries(plex)
     playlist_data = read_csv_files(csv_directory)
 
-    if playlist_data:
-        for playlist_name, songs in playlist_data.items():
-            confirmation = UserInputs.input(f"Do you want to process the CSV for playlist {playlist_name} (y/N)? ")
-            if confirmation.lower() != 'y':
-                logging.info(f"Skipping CSV for playlist {playlist_name}.")
-                continue
-            logging.info(f"Processing playlist: {playlist_name}")
-            available_tracks, missing_tracks, found_tracks = _get_available_plex_tracks(plex, songs, playlist_name)
-            confirm_and_add_tracks(plex, playlist_name, missing_tracks, found_tracks, csv_directory)
+    # Ask about every CSV up front so the Plex lookups below run without waiting on input
+    selected_playlists = []
+    for playlist_name in playlist_data:
+        confirmation = UserInputs.input(f"Do you want to process the CSV for playlist {playlist_name} (y/N)? ")
+        if confirmation.lower() != 'y':
+            logger.info("Skipping CSV for playlist %s.", playlist_name)
+            continue
+        selected_playlists.append(playlist_name)
+
+    if selected_playlists:
+        # Indexing downloads every track in the library, so it waits until there is something to match
+        build_artist_index(selected_library)
+        if cache_directory:
+            load_song_matches(cache_directory, selected_library)
+
+        playlist_matches = {}
+        for playlist_name in selected_playlists:
+            logger.info("Processing playlist: %s", playlist_name)
+            playlist_matches[playlist_name] = _get_available_plex_tracks(plex, selected_library, playlist_data[playlist_name], playlist_name)
+        if cache_directory:
+            save_song_matches(cache_directory, selected_library)
+
+        for playlist_name, (available_tracks, missing_tracks, found_tracks) in playlist_matches.items():
+            confirm_and_add_tracks(plex, playlist_name, available_tracks, missing_tracks, found_tracks, csv_directory)
 
     print("All CSVs processed.")
 